@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import tempfile
+import networkx as nx
+
+def cache_dir():
+    """Directory of the on-disk caches, can be changed with the SPATIAL_REQUESTS_CACHE environment variable"""
+    default = os.path.join(os.path.expanduser("~"), ".cache", "spatial_requests")
+    return os.environ.get("SPATIAL_REQUESTS_CACHE", default)
+
+def grammar_cache_file():
+    """Cache file for the LALR tables of the request grammar"""
+    return os.path.join(cache_dir(), "spatial_grammar.cache")
+
+def dfa_to_dict(dfa):
+    edges = []
+    for node_from, node_to, data in dfa.edges(data=True):
+        edges.append([node_from, node_to, list(data['guard'])])
+
+    return {
+        "ap": dfa.graph['ap'],
+        "acc": dfa.graph['acc'],
+        "init": dfa.graph['init'],
+        "edges": edges,
+    }
+
+def dfa_from_dict(data):
+    dfa = nx.DiGraph()
+    dfa.graph['ap'] = data["ap"]
+    dfa.graph['acc'] = data["acc"]
+    dfa.graph['init'] = data["init"]
+    for node_from, node_to, guard in data["edges"]:
+        dfa.add_edge(node_from, node_to, guard=guard)
+    return dfa
+
+def dfa_cache_file(spec):
+    key = hashlib.sha1(spec.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), "dfa", key + ".json")
+
+def load_dfa(spec):
+    """Returns the cached DFA of a specification or None"""
+    path = dfa_cache_file(spec)
+    if not os.path.exists(path):
+        return None
+
+    # unreadable or corrupt entries are treated as a cache miss
+    try:
+        with open(path) as f:
+            data = json.load(f)
+
+        # guard against hash collisions
+        if data["spec"] != spec:
+            return None
+        return dfa_from_dict(data["dfa"])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("Ignoring broken DFA cache entry", path, ":", e)
+        return None
+
+def store_dfa(spec, dfa):
+    """Caches the DFA of a specification, failing silently if the cache is not writable"""
+    path = dfa_cache_file(spec)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first, so parallel workers never read a half-written entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"spec": spec, "dfa": dfa_to_dict(dfa)}, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError as e:
+        print("Could not write the DFA cache:", e)
@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import queue
+import threading
+from datetime import datetime
+import numpy as np
+
+class MapExporter:
+    """Dumps gradient maps and object outlines to disk in a background thread and renders them to images
+    in a separate process, so exporting never blocks planning."""
+
+    def __init__(self, directory, compressed=True, render=True, max_pending=64):
+        """
+        Args:
+            directory: where records are written, created if it does not exist
+            compressed: True writes one compressed .npz per record,
+                False writes a folder of .npy files per record that can be opened with np.load(mmap_mode='r')
+            render: also render each record to a .png
+            max_pending: records waiting for a worker, further records are dropped instead of blocking
+        """
+        self.directory = directory
+        self.compressed = compressed
+        # records of several sessions can share a directory, the prefix keeps them apart
+        self.session = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.counter = 0
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+        # matplotlib holds the GIL while drawing, so rendering must not share the planner's process
+        self.renderer = None
+        if render:
+            context = multiprocessing.get_context("spawn")
+            self.render_queue = context.Queue(maxsize=max_pending)
+            self.renderer = context.Process(target=render_worker, args=(self.render_queue,), daemon=True)
+            self.renderer.start()
+
+    def export(self, name, gx, gy, target_map, constraint_map, target_point, objects):
+        """Queues a record, copying all arrays so the planner can keep modifying its own"""
+        record = {
+            "name": "%s_%05d_%s" % (self.session, self.counter, name),
+            "gx": gx,
+            "gy": gy,
+            "target_map": np.array(target_map, dtype=float).reshape(gx.shape),
+            "constraint_map": None if constraint_map is None or len(constraint_map) == 0
+                else np.array(constraint_map, dtype=float).reshape(gx.shape),
+            "target_point": None if target_point is None else np.array(target_point, dtype=float),
+            "outlines": {obj.name: (np.array(obj.shape.vertices, dtype=float), obj.color) for obj in objects},
+        }
+        self.counter += 1
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, wait=True):
+        """Stops the workers once all queued records are written and rendered, optionally waiting for them"""
+        self.queue.put(None)
+        if wait:
+            self.worker.join()
+            if self.renderer is not None:
+                self.renderer.join()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                # stop the renderer after the records queued so far
+                if self.renderer is not None:
+                    self.render_queue.put(None)
+                break
+            try:
+                path = self.write(record)
+                if self.renderer is not None:
+                    self.render_queue.put_nowait(path)
+            except queue.Full:
+                self.dropped += 1
+            except Exception as e:
+                print("Map export of", record["name"], "failed:", e)
+
+    def write(self, record):
+        """Writes a record and returns its path"""
+        arrays = {
+            "gx": record["gx"],
+            "gy": record["gy"],
+            "target_map": record["target_map"],
+        }
+        if record["constraint_map"] is not None:
+            arrays["constraint_map"] = record["constraint_map"]
+        if record["target_point"] is not None:
+            arrays["target_point"] = record["target_point"]
+        for obj_name, (vertices, color) in record["outlines"].items():
+            arrays["outline_" + obj_name] = vertices
+            arrays["color_" + obj_name] = np.array(color)
+
+        if self.compressed:
+            path = os.path.join(self.directory, record["name"] + ".npz")
+            np.savez_compressed(path, **arrays)
+        else:
+            path = os.path.join(self.directory, record["name"])
+            os.makedirs(path, exist_ok=True)
+            for key, values in arrays.items():
+                np.save(os.path.join(path, key + ".npy"), values)
+        return path
+
+def read_record(path):
+    """Reads a record written by MapExporter, either a .npz file or a folder of .npy files"""
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    arrays = {}
+    for file_name in os.listdir(path):
+        if file_name.endswith(".npy"):
+            arrays[file_name[:-4]] = np.load(os.path.join(path, file_name))
+    return arrays
+
+def render_record(path):
+    """Same plot as SpatialRequestPlanner.visualize_map, but drawn off-screen into <record>.png"""
+    # pyplot is not needed, we draw on a figure that is not managed by it
+    from matplotlib.figure import Figure
+    from matplotlib import cm
+
+    arrays = read_record(path)
+    fig = Figure()
+    ax = fig.add_subplot(111)
+    values_2d = arrays["target_map"]
+    if not np.all(np.isnan(values_2d)):
+        # cap the number of levels, wide value ranges would take ages to draw
+        granularity = 0.05
+        levels = min(int((np.nanmax(values_2d) - np.nanmin(values_2d)) / granularity) + 3, 100)
+        con = ax.contourf(arrays["gx"], arrays["gy"], values_2d,
+                          levels=np.linspace(np.nanmin(values_2d) - granularity, np.nanmax(values_2d) + granularity, levels),
+                          cmap=cm.coolwarm,
+                          alpha=0.3,
+                          antialiased=False)
+        fig.colorbar(con)
+    # plot objects
+    for key, vertices in arrays.items():
+        if not key.startswith("outline_"):
+            continue
+        closed = np.vstack([vertices, vertices[:1]])
+        ax.plot(closed[:, 0], closed[:, 1], color=str(arrays["color_" + key[len("outline_"):]]))
+    # plot target point
+    if "target_point" in arrays:
+        ax.plot(arrays["target_point"][0], arrays["target_point"][1], "og")
+    ax.autoscale()
+
+    base = path[:-len(".npz")] if path.endswith(".npz") else path
+    fig.savefig(base + ".png")
+
+def render_worker(render_queue):
+    """Renders record paths from the queue until it receives None, runs in its own process"""
+    # lowest priority, the planner keeps the CPU even if there are no spare cores
+    if hasattr(os, "nice"):
+        os.nice(19)
+
+    while True:
+        path = render_queue.get()
+        if path is None:
+            break
+        try:
+            render_record(path)
+        except Exception as e:
+            print("Rendering of", path, "failed:", e)
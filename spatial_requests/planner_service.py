@@ -1,7 +1,10 @@
-from spatial_requests.spatial_request_planner import SpatialRequestPlanner
-from spatial_requests.projected_object import ProjectedObject
 from spatial_requests.command import Command, CommandType
+from spatial_requests.map_export import MapExporter
 
+import argparse
+import importlib
+import os
+import threading
 import time
 import zmq
 import json
@@ -13,8 +16,40 @@ def preprocess_points(points):
     points[:,1] *= -1
     return points
 
+def resolve_client_path(root, name):
+    """Resolves a file name sent by a client inside a directory chosen on the command line.
+    Absolute paths and paths leaving the directory are rejected, clients must not reach arbitrary files."""
+    if not isinstance(name, str) or not name or os.path.isabs(name) or ".." in name.replace("\\", "/").split("/"):
+        raise ValueError("Invalid path %r, expected a relative path inside %s" % (name, root))
+
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError("Invalid path %r, expected a relative path inside %s" % (name, root))
+    return path
+
+object_colors = {
+    'banana': 'y',
+    'brick': 'b',
+    'hammer': 'r',
+}
+
 class PlannerService:
 
+    def __init__(self, observation_rate=10.0, snapshot_dir="snapshots", export_root="exports"):
+        self.planner = None
+        self.last_command = None
+        self.map_exporter = None
+
+        # client messages only name files inside these directories
+        self.snapshot_dir = snapshot_dir
+        self.export_root = export_root
+
+        # newest object per name from the observation channel, applied at most observation_rate times per second
+        self.pending_observations = {}
+        self.observation_period = 1.0 / observation_rate
+        self.last_observation_update = 0.0
+
     def on_request(self, message):
         request = json.loads(message)
         response = {}
@@ -32,10 +67,20 @@ class PlannerService:
         elif request["action"] == "grasp_failed":
             print("\n Received grasp failure notification.")
             response = self.on_fail(request)
+        elif request["action"] == "save":
+            print("\nReceived save request.")
+            response = self.on_save(request)
+        elif request["action"] == "load":
+            print("\nReceived load request.")
+            response = self.on_load(request)
 
         return json.dumps(response)
     
     def on_init(self, msg):
+        # the planner pulls in spatial_spec (matplotlib, sympy, networkx), so it is imported on first use
+        from spatial_requests.spatial_request_planner import SpatialRequestPlanner
+        from spatial_requests.projected_object import ProjectedObject
+
         # load spec
         spec = msg["specification"]
 
@@ -60,8 +105,14 @@ class PlannerService:
                 proj_points=preprocess_points(msg["hammer"])),
         ]
             
-        # create planner
-        self.planner = SpatialRequestPlanner(spec, objects, bounds, samples=500)
+        # create planner, "guided" explores the automaton edges best-first instead of trial-and-prune
+        edge_selection = msg.get("edge_selection", "shortest_path")
+
+        self.planner = SpatialRequestPlanner(spec, objects, bounds, samples=500, edge_selection=edge_selection,
+                                             map_exporter=self.create_map_exporter(msg),
+                                             refine_evaluations=msg.get("refine_evaluations", 0))
+        # frames of the previous session must not reach the new planner
+        self.pending_observations = {}
 
         return {
             "response": "ack",
@@ -69,7 +120,21 @@ class PlannerService:
             "spec_satisfied" : self.planner.currently_accepting()
             }
 
+    def create_map_exporter(self, msg):
+        """Optionally dumps all computed maps, written and rendered in the background.
+        The exporter of the previous session is stopped, it finishes its queued records on its own."""
+        if self.map_exporter is not None:
+            self.map_exporter.close(wait=False)
+            self.map_exporter = None
+
+        if "export_dir" in msg:
+            export_dir = resolve_client_path(self.export_root, msg["export_dir"])
+            self.map_exporter = MapExporter(export_dir, compressed=msg.get("export_compressed", True))
+        return self.map_exporter
+
     def on_observation(self, msg):
+        from spatial_requests.projected_object import ProjectedObject
+
         assert self.planner is not None, "Please send an init message first"
         assert "banana" in msg and "brick" in msg and "hammer" in msg, "Not all objects are included."
         objects = [
@@ -86,6 +151,9 @@ class PlannerService:
                 color='r',
                 proj_points=preprocess_points(msg["hammer"])),
         ]
+        # queued frames are older than this observation
+        for obj in objects:
+            self.pending_observations.pop(obj.name, None)
         self.planner.register_observation(objects)
         return {
             "response": "ack",
@@ -95,6 +163,8 @@ class PlannerService:
     
     def on_plan(self, msg):
         assert self.planner is not None, "Please send an init message first"
+        # always plan on the freshest scene
+        self.apply_pending_observations()
         command = self.planner.get_next_step()
         self.last_command = command
 
@@ -137,16 +207,129 @@ class PlannerService:
         }
 
 
+    def on_save(self, msg):
+        assert self.planner is not None, "Please send an init message first"
+        assert "path" in msg, "Please specify a snapshot path"
+        path = resolve_client_path(self.snapshot_dir, msg["path"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.planner.save(path, include_maps=msg.get("include_maps", False))
+
+        return {
+            "response": "ack",
+            "spec_satisfied": self.planner.currently_accepting(),
+            "info": "The planner session is saved.",
+        }
+
+    def on_load(self, msg):
+        from spatial_requests.spatial_request_planner import SpatialRequestPlanner
+
+        assert "path" in msg, "Please specify a snapshot path"
+        path = resolve_client_path(self.snapshot_dir, msg["path"])
+        self.planner = SpatialRequestPlanner.load(path, map_exporter=self.create_map_exporter(msg))
+        self.last_command = self.planner.last_command
+        self.pending_observations = {}
+
+        return {
+            "response": "ack",
+            "spec_satisfied": self.planner.currently_accepting(),
+            "info": "The planner session is restored.",
+        }
+
+    def on_observation_frame(self, message):
+        """Coalesces a frame from the observation channel, only the newest object per name is kept.
+        Malformed frames are discarded, they must not take down the service."""
+        from spatial_requests.projected_object import ProjectedObject
+
+        # nothing to apply the frames to yet
+        if self.planner is None:
+            return
+
+        try:
+            msg = json.loads(message)
+            if not isinstance(msg, dict):
+                raise ValueError("Frame is not a JSON object.")
+            objects = [
+                ProjectedObject(
+                    name=name,
+                    color=object_colors[name],
+                    proj_points=preprocess_points(msg[name]))
+                for name in object_colors.keys() if name in msg
+            ]
+        except Exception as e:
+            print("Discarding malformed observation frame:", e)
+            return
+
+        for obj in objects:
+            self.pending_observations[obj.name] = obj
+
+    def apply_pending_observations(self):
+        """Registers the coalesced frames with the planner, returns True if the scene was updated"""
+        if self.planner is None or not self.pending_observations:
+            return False
+
+        objects = list(self.pending_observations.values())
+        self.pending_observations = {}
+        self.last_observation_update = time.monotonic()
+        self.planner.register_observation(objects)
+        return True
+
+    def observation_due(self):
+        return time.monotonic() - self.last_observation_update >= self.observation_period
+
+
+def drain_observations(sub_socket, service):
+    """Reads all queued frames without blocking, so stale frames are coalesced instead of evaluated"""
+    while sub_socket.poll(0):
+        service.on_observation_frame(sub_socket.recv())
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Planner service, answers requests on a REP socket.")
+    parser.add_argument("--port", type=int, default=5000, help="request/reply port")
+    parser.add_argument("--observation-port", type=int, default=5001,
+                        help="port of the SUB socket for observation frames, published in the observation message format")
+    parser.add_argument("--observation-rate", type=float, default=10.0,
+                        help="maximum rate (Hz) at which observation frames are applied to the automaton")
+    parser.add_argument("--snapshot-dir", default="snapshots",
+                        help="directory of the snapshots, paths in save/load requests are relative to it")
+    parser.add_argument("--export-root", default="exports",
+                        help="directory of the map exports, export_dir in init/load requests is relative to it")
+    args = parser.parse_args()
+
     context = zmq.Context()
     socket = context.socket(zmq.REP)
-    socket.bind("tcp://0.0.0.0:5000")
+    socket.bind("tcp://0.0.0.0:%d" % args.port)
+
+    # observations can also be published, they are coalesced per object
+    sub_socket = context.socket(zmq.SUB)
+    sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+    sub_socket.bind("tcp://0.0.0.0:%d" % args.observation_port)
 
-    service = PlannerService()
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    poller.register(sub_socket, zmq.POLLIN)
+
+    service = PlannerService(observation_rate=args.observation_rate, snapshot_dir=args.snapshot_dir,
+                             export_root=args.export_root)
     print("Socket created. Waiting for requests...")
+
+    # import the planner in the background while waiting for the first request
+    threading.Thread(target=importlib.import_module, args=("spatial_requests.spatial_request_planner",), daemon=True).start()
  
     while True:
+        # wait for the next request, observation frame, or until pending frames are due
+        timeout = None
+        if service.pending_observations:
+            timeout = max(0, int(1000 * (service.last_observation_update + service.observation_period - time.monotonic())))
+        events = dict(poller.poll(timeout))
+
+        drain_observations(sub_socket, service)
+        if service.observation_due():
+            service.apply_pending_observations()
+
+        if socket not in events:
+            continue
+
         #  Wait for next request from client
         message = socket.recv()
 
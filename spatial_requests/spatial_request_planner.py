@@ -2,35 +2,79 @@ from spatial_spec.logic import Spatial
 from spatial_spec.automaton_planning import AutomatonPlanner
 from spatial_requests.command import Command, CommandType
 from spatial_requests.guard_utility import reduce_set_of_guards, sog_fits_to_guard
+from spatial_requests.projected_object import ProjectedObject
+from spatial_requests.cache import dfa_from_dict, dfa_to_dict, grammar_cache_file, load_dfa, store_dfa
 from spatial_spec.geometry import Polygon, PolygonCollection, StaticObject
 
 import copy
+import json
 import os
+from collections import OrderedDict
 import numpy as np
 import networkx as nx
 from lark import Token, Lark
-from lark.reconstruct import Reconstructor
-import matplotlib.pyplot as plt
-from matplotlib import cm
+
+def build_reconstructor():
+    """Builds the reconstructor that turns spatial subtrees back into strings, caching the parser tables on disk"""
+    from lark.reconstruct import Reconstructor
+
+    grammar = os.path.dirname(__file__) + "/spatial.lark"
+    cache_file = grammar_cache_file()
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    except OSError:
+        cache_file = False
+    parser = Lark.open(grammar, parser='lalr', maybe_placeholders=False, cache=cache_file)
+    return Reconstructor(parser)
 
 class SpatialRequestPlanner:
 
-    def __init__(self, spec, graspable_objects, bounds, samples):
+    unmovable_objects = ["banana", "top_left_corner", "top_right_corner", "bottom_left_corner", "bottom_right_corner"]
+
+    def __init__(self, spec, graspable_objects, bounds, samples, edge_selection="shortest_path",
+                 scene_resolution=None, feasibility_memory_size=1024, dfa=None, map_exporter=None,
+                 refine_evaluations=0, refine_starts=3):
+        assert edge_selection in ("shortest_path", "guided"), "Unknown edge selection mode: %s" % edge_selection
         self.spatial = Spatial(quantitative=True)
         self.planner = AutomatonPlanner()
+        self.spec = spec
         self.bounds = bounds
+        self.samples = samples
+        self.edge_selection = edge_selection
         self.pruned_edges = {}
-
-        grammar = os.path.dirname(__file__) + "/spatial.lark"
-        parser = Lark.open(grammar, parser='lalr', maybe_placeholders=False)
-        self.reconstructor = Reconstructor(parser)
+        # edge -> reduced target guards, the guards of an edge never change
+        self.reduced_targets = {}
+        # (edge, scene signature) -> False for edges found infeasible in that scene, least recently used first
+        self.feasibility_memory = OrderedDict()
+        self.feasibility_memory_size = feasibility_memory_size
+        self.ap_values = {}
+        # (object name, atomic proposition) -> gradient map, valid until an object moves
+        self.map_cache = {}
+        self.last_command = None
+        # optional MapExporter, dumps every computed map without blocking
+        self.map_exporter = map_exporter
+        # budget of the continuous refinement of grid placements, 0 disables it
+        self.refine_evaluations = refine_evaluations
+        self.refine_starts = refine_starts
+
+        # the reconstructor is only needed for requests, it is built on first use
+        self._reconstructor = None
 
         self.graspable_objects = {}
         for obj in graspable_objects:
             self.graspable_objects[obj.name] = obj
 
         spec_tree = self.spatial.parse(spec)
-        self.planner.tree_to_dfa(spec_tree)
+        if dfa is None:
+            dfa = load_dfa(spec)
+        if dfa is None:
+            self.planner.tree_to_dfa(spec_tree)
+            if self.planner.dfa is not None:
+                store_dfa(spec, self.planner.dfa)
+        else:
+            # restoring a snapshot or cached DFA, we only need the variable mapping and skip the expensive DFA construction
+            self.planner.temporal_formula = self.planner.extract_temporal(spec_tree)
+            self.planner.dfa = dfa
         self.orig_dfa = copy.deepcopy(self.planner.dfa)
         print("\ntemporal structure:", self.planner.temporal_formula)
         print("planner DFA nodes:", len(self.planner.dfa.nodes)," , edges:", len(self.planner.dfa.edges))
@@ -38,6 +82,12 @@ class SpatialRequestPlanner:
         # build workspace grid
         self.sample_points = self.sample_grid_mesh(bounds, samples)
 
+        # objects moving less than this are considered to be in the same scene, defaults to the grid spacing
+        if scene_resolution is None:
+            scene_resolution = max(abs(self.rx[1] - self.rx[0]), abs(self.ry[1] - self.ry[0]))
+        self.scene_resolution = scene_resolution
+        self.scene = self.scene_signature()
+
         # object initialization - spatial variables
         for name, grasp_obj in self.graspable_objects.items():
             self.spatial.assign_variable(name, grasp_obj.get_static_shape())
@@ -50,6 +100,14 @@ class SpatialRequestPlanner:
         # you have to define in which order you pass variable assignments to the planner
         self.trace_ap = list(self.spatial_vars.keys())
 
+        # movable objects that can change the value of each atomic proposition
+        self.ap_objects = {}
+        for var_ap, subtree in self.spatial_vars.items():
+            self.ap_objects[var_ap] = set()
+            for token in subtree.scan_values(lambda x: isinstance(x, Token)):
+                if token.type == 'NAME' and token.value not in self.unmovable_objects:
+                    self.ap_objects[var_ap].add(token.value)
+
         # resets the automaton current state to the initial state (doesn't do anything here)
         self.planner.reset_state()
 
@@ -86,7 +144,9 @@ class SpatialRequestPlanner:
         obs = ''
         for var_ap in self.trace_ap:
             subtree = self.spatial_vars[var_ap]
-            if self.spatial.interpret(subtree) > 0:
+            # remember the satisfaction values, the guided edge selection uses them as cheap cost estimates
+            self.ap_values[var_ap] = self.spatial.interpret(subtree)
+            if self.ap_values[var_ap] > 0:
                 obs += '1'
             else:
                 obs += '0'
@@ -113,7 +173,6 @@ class SpatialRequestPlanner:
     def get_relevant_objects(self, targets):
         """Returns the relevant object names from a set of target boolean configurations"""
         relv_objs = set()
-        unmovable_objects = ["banana", "top_left_corner", "top_right_corner", "bottom_left_corner", "bottom_right_corner"]
         dfa_ap = self.planner.get_dfa_ap()
 
         for trgt in targets:
@@ -125,7 +184,7 @@ class SpatialRequestPlanner:
                 subtree = self.spatial_vars[dfa_ap[i]]
                 # get all leaves that correspond to a variable
                 for token in subtree.scan_values(lambda x: isinstance(x, Token)):
-                    if token.type == 'NAME' and token.value not in unmovable_objects:
+                    if token.type == 'NAME' and token.value not in self.unmovable_objects:
                         relv_objs.add(token.value)
 
         return relv_objs
@@ -155,13 +214,16 @@ class SpatialRequestPlanner:
             if guard_val == 'X':
                 continue
 
-            # evaluate for that object
-            tree = self.spatial_vars[dfa_ap[i]]
-            gradient_values = self.gradient_map(object_to_move, tree)
+            # evaluate for that object, maps are cached until an object moves
+            key = (object_to_move.name, dfa_ap[i])
+            if key not in self.map_cache:
+                tree = self.spatial_vars[dfa_ap[i]]
+                self.map_cache[key] = np.array(self.gradient_map(object_to_move, tree), dtype=float)
+            gradient_values = self.map_cache[key].copy()
 
             # if the guard has the variable as negative, flip the gradient map
             if guard_val == '0':
-                gradient_values = [-1 * x for x in gradient_values]
+                gradient_values = -1 * gradient_values
 
             # merge results into the constraint_map (by logical conjunction)
             if len(result) > 0:
@@ -217,8 +279,98 @@ class SpatialRequestPlanner:
 
         return np.array([self.rx[id_y], self.ry[id_x]])
     
+    @property
+    def reconstructor(self):
+        if self._reconstructor is None:
+            self._reconstructor = build_reconstructor()
+        return self._reconstructor
+
+    def point_value(self, object_to_move, guard, pos):
+        """Satisfaction value of a guard with the object moved to a single position, the continuous version of gradient_map_from_guard"""
+        d = pos - object_to_move.shape.center
+        virtual_shape = object_to_move.get_displaced_static_shape(d)
+        self.spatial.reset_spatial_dict()
+        self.spatial.assign_variable(object_to_move.name, virtual_shape)
+        dfa_ap = self.planner.get_dfa_ap()
+
+        value = np.inf
+        for i, guard_val in enumerate(guard):
+            if guard_val == 'X':
+                continue
+            ap_value = self.spatial.interpret(self.spatial_vars[dfa_ap[i]])
+            if guard_val == '0':
+                ap_value = -ap_value
+            value = min(value, ap_value)
+        return value
+
+    def placement_value(self, object_to_move, target, constraints, pos):
+        """Target value at a position, or None if the position leaves the workspace or satisfies a constraint"""
+        # the service flips the y axis, so the bounds are not necessarily ordered
+        if not (min(self.rx[0], self.rx[-1]) <= pos[0] <= max(self.rx[0], self.rx[-1])
+                and min(self.ry[0], self.ry[-1]) <= pos[1] <= max(self.ry[0], self.ry[-1])):
+            return None
+        for constraint in constraints:
+            if self.point_value(object_to_move, constraint, pos) > 0:
+                return None
+        return self.point_value(object_to_move, target, pos)
+
+    def refine_point(self, object_to_move, target, constraints, target_map, grid_point):
+        """Locally maximizes the target value by compass search, starting from the best grid cells.
+        The search stays in the workspace and never enters positions that satisfy a constraint."""
+        # best feasible grid cells, the masked map already contains nan for constrained cells
+        values = np.array(target_map, dtype=float)
+        values[np.isnan(values)] = -np.inf
+        order = np.argsort(values)[::-1]
+        starts = [self.sample_points[v] for v in order[:self.refine_starts] if values[v] > 0]
+        if not starts:
+            starts = [grid_point]
+
+        budget = max(self.refine_evaluations // len(starts), 1)
+        initial_step = max(abs(self.rx[1] - self.rx[0]), abs(self.ry[1] - self.ry[0])) * 0.5
+        directions = np.array([[1, 0], [-1, 0], [0, 1], [0, -1]], dtype=float)
+
+        best_point = np.array(grid_point, dtype=float)
+        best_value = self.placement_value(object_to_move, target, constraints, best_point)
+        evaluations = 1
+        for start in starts:
+            point = np.array(start, dtype=float)
+            value = self.placement_value(object_to_move, target, constraints, point)
+            if value is None:
+                continue
+            step = initial_step
+            used = 1
+
+            # move to the first improving neighbour, shrink the step if there is none
+            while used < budget and step > 1e-3 * initial_step:
+                improved = False
+                for direction in directions:
+                    if used >= budget:
+                        break
+                    candidate = point + step * direction
+                    candidate_value = self.placement_value(object_to_move, target, constraints, candidate)
+                    used += 1
+                    if candidate_value is not None and candidate_value > value:
+                        point, value = candidate, candidate_value
+                        improved = True
+                        break
+                if not improved:
+                    step *= 0.5
+
+            evaluations += used
+            if best_value is None or value > best_value:
+                best_point, best_value = point, value
+
+        # reset the object position
+        self.spatial.reset_spatial_dict()
+        self.spatial.assign_variable(object_to_move.name, object_to_move.get_static_shape())
+        print("Refined placement with", evaluations, "evaluations, value:", best_value)
+        return best_point
+
     def visualize_map(self, target_map, target_point, proj_objs):
         """Plots gradient values"""
+        import matplotlib.pyplot as plt
+        from matplotlib import cm
+
         fig = plt.figure()
         ax = fig.add_subplot(111)
         values_2d = np.array(target_map).reshape(self.gx.shape)
@@ -238,6 +390,8 @@ class SpatialRequestPlanner:
         plt.show()
 
     def viz_objects(self):
+        import matplotlib.pyplot as plt
+
         fig = plt.figure()
         ax = fig.add_subplot(111)
         # plot objects
@@ -345,10 +499,53 @@ class SpatialRequestPlanner:
         """
         return request_str
 
+    def scene_signature(self):
+        """Quantizes the bounding boxes of all graspable objects. Scenes with the same signature share feasibility results."""
+        signature = []
+        for name in sorted(self.graspable_objects.keys()):
+            vertices = self.graspable_objects[name].shape.vertices
+            box = np.concatenate([vertices.min(axis=0), vertices.max(axis=0)])
+            signature.append((name,) + tuple(int(v) for v in np.round(box / self.scene_resolution)))
+        return tuple(signature)
+
+    def remember_infeasible(self, edge):
+        key = (edge, self.scene)
+        self.feasibility_memory[key] = False
+        self.feasibility_memory.move_to_end(key)
+
+        # evict the least recently used entries
+        while len(self.feasibility_memory) > self.feasibility_memory_size:
+            self.feasibility_memory.popitem(last=False)
+
+    def update_scene(self):
+        """Restores all edges if the scene changed, except the ones already known to be infeasible in the new scene"""
+        signature = self.scene_signature()
+        if signature == self.scene:
+            return
+
+        self.scene = signature
+        self.planner.dfa = copy.deepcopy(self.orig_dfa)
+        self.pruned_edges = {}
+
+        for key in list(self.feasibility_memory.keys()):
+            edge, scene = key
+            if scene == signature:
+                self.feasibility_memory.move_to_end(key)
+                self.disable_edge(edge)
+
     def prune_edge(self, edge):
+        """Disables an infeasible edge and remembers it for the current scene"""
+        self.remember_infeasible(edge)
+        self.disable_edge(edge)
+
+    def disable_edge(self, edge):
         node_cur = edge[0]
         node_to = edge[1]
 
+        # the edge may already be disabled, e.g. after a grasp failure
+        if not self.planner.dfa.has_edge(node_cur, node_to):
+            return
+
         # obtain guards for the edge and guards for the self loop
         target_guards = self.orig_dfa.edges[node_cur, node_to]['guard']
         loop_guards = self.orig_dfa.edges[node_cur, node_cur]['guard'] # we assume this to always exist
@@ -377,7 +574,13 @@ class SpatialRequestPlanner:
     def register_observation(self, object_list) -> None:
         # update objects
         for obj in object_list:
+            old_obj = self.graspable_objects.get(obj.name)
+            if old_obj is None or not np.array_equal(old_obj.proj_points, obj.proj_points):
+                self.map_cache = {}
             self.graspable_objects[obj.name] = obj
+
+        # previously pruned edges might be feasible again in the new scene
+        self.update_scene()
         
         # register observation, we use the original dfa so it can use pruned edges
         node_cur = self.planner.current_state
@@ -391,10 +594,148 @@ class SpatialRequestPlanner:
                 self.planner.current_state = succ
                 break
 
+    def guard_cost(self, guard):
+        """Estimates the effort to satisfy a guard from the current scene and returns the objects able to do it.
+        Returns infinite cost if no single movable object can flip all required atomic propositions."""
+        dfa_ap = self.planner.get_dfa_ap()
+        diagonal = np.hypot(self.bounds[1] - self.bounds[0], self.bounds[3] - self.bounds[2])
+        cost = 0.0
+        candidates = None
+
+        for i, guard_val in enumerate(guard):
+            if guard_val == 'X':
+                continue
+            value = self.ap_values[dfa_ap[i]]
+            if (value > 0) == (guard_val == '1'):
+                continue
+
+            # every flipped proposition costs at least one, plus how far it is from flipping relative to the workspace
+            cost += 1.0 + min(abs(value) / diagonal, 1.0)
+
+            # we move a single object, so it has to appear in all flipped propositions
+            if candidates is None:
+                candidates = set(self.ap_objects[dfa_ap[i]])
+            else:
+                candidates &= self.ap_objects[dfa_ap[i]]
+
+        # nothing to flip, any object in the guard will do
+        if candidates is None:
+            candidates = set()
+            for i, guard_val in enumerate(guard):
+                if guard_val != 'X':
+                    candidates |= self.ap_objects[dfa_ap[i]]
+            return cost, candidates
+
+        if not candidates:
+            return float('inf'), candidates
+        return cost, candidates
+
+    def target_guards(self, edge):
+        """Returns the reduced target guards of an edge, computed once per edge"""
+        if edge not in self.reduced_targets:
+            self.reduced_targets[edge] = reduce_set_of_guards(self.orig_dfa.edges[edge]['guard'])
+        return self.reduced_targets[edge]
+
+    def edge_guards(self, edge):
+        """Returns the target and constraint guards of an edge in the current (pruned) automaton"""
+        node_cur, node_to = edge
+        constraint_guards = []
+        for succ in self.planner.dfa.successors(node_cur):
+            if succ != node_to and succ != node_cur:
+                constraint_guards.extend(self.planner.dfa.edges[node_cur, succ]['guard'])
+        return self.target_guards(edge), reduce_set_of_guards(constraint_guards)
+
+    def rank_edges(self, node_cur):
+        """Scores all outgoing edges of the current state that still lead to an accepting state, cheapest first.
+        The score combines the remaining path length and the estimated guard cost. Previous failures need no penalty,
+        edges known to be infeasible in the current scene are disabled by the feasibility memory."""
+        ranked = []
+        acc = self.planner.dfa.graph['acc']
+
+        for succ in self.planner.dfa.successors(node_cur):
+            if succ == node_cur:
+                continue
+
+            # remaining path length to the closest accepting state
+            lengths = nx.single_source_shortest_path_length(self.planner.dfa, succ)
+            hops = min((lengths[node_acc] for node_acc in acc if node_acc in lengths), default=None)
+            if hops is None:
+                continue
+
+            # only the target guards are needed for scoring, constraints are built for the edge actually tried
+            edge = (node_cur, succ)
+            cost = float('inf')
+            objects = set()
+            for target in self.target_guards(edge):
+                target_cost, target_objects = self.guard_cost(target)
+                cost = min(cost, target_cost)
+                objects |= target_objects
+
+            score = hops + cost
+            ranked.append((score, edge, objects))
+
+        ranked.sort(key=lambda x: x[0])
+        return ranked
+
+    def find_placement(self, target_set, constraint_set, edge, obj_names):
+        """Tries to find a position for one of the given objects that satisfies a target and none of the constraints"""
+        for obj_name in obj_names:
+            print("Considering ", obj_name, "...")
+            relevant_obj = self.graspable_objects[obj_name]
+            composite_constraint_map = self.composite_constraint_map(relevant_obj, constraint_set)
+
+            # try out all target options
+            for target in target_set:
+                target_map = self.gradient_map_from_guard(relevant_obj, guard=target)
+
+                # remove the composite constraint from the map
+                if constraint_set:
+                    assert len(target_map) == len(composite_constraint_map)
+                    for v in range(len(target_map)):
+                        if composite_constraint_map[v] > 0:
+                            target_map[v] = np.nan
+                
+                # find the best point for the object
+                target_point = self.find_best_point(np.array(target_map).reshape(self.gx.shape), threshold=0)
+
+                # improve the grid optimum in continuous space
+                if target_point is not None and self.refine_evaluations > 0:
+                    target_point = self.refine_point(relevant_obj, target, constraint_set, target_map, target_point)
+
+                if self.map_exporter is not None:
+                    self.map_exporter.export("%s_%s-%s_%s" % (obj_name, edge[0], edge[1], target), self.gx, self.gy,
+                                             target_map, composite_constraint_map, target_point, self.graspable_objects.values())
+
+                # if we found a point, good!
+                if target_point is not None:
+                    print("Found a point for ",obj_name, "!")
+                    #self.visualize_map(target_map, target_point, self.graspable_objects)
+                    return Command(CommandType.EXECUTE, obj_name=obj_name, new_pos=target_point, edge=edge)
+
+        return None
+
+    def request_or_none(self):
+        """Called when no path to an accepting state exists anymore, checks for a possible request"""
+        node_current = self.planner.current_state
+        node_request = self.find_smallest_request(node_current)
+        if not node_request:
+            print("Specification impossible to satisfy anymore.")
+            return Command(CommandType.NONE)
+        else:
+            print("Sending a request...")
+            request_str = self.generate_request_str(node_current, node_request)
+            return Command(CommandType.REQUEST, request_str=request_str)
+
     def get_next_step(self) -> Command:
+        if self.edge_selection == "guided":
+            self.last_command = self.get_next_step_guided()
+        else:
+            self.last_command = self.get_next_step_shortest_path()
+        return self.last_command
+
+    def get_next_step_shortest_path(self) -> Command:
         print("Searching for target transition...")
         # loop until we have a target or no path to accepting states exist anymore (due to pruning infeasible edges)
-        target_obj = None
         while True:
             target_set, constraint_set, edge = self.planner.plan_step()
 
@@ -405,46 +746,134 @@ class SpatialRequestPlanner:
 
             # no path to accepting state exists, check for possible request
             if not target_set:
-                node_current = self.planner.current_state
-                node_request = self.find_smallest_request(node_current)
-                if not node_request:
-                    print("Specification impossible to satisfy anymore.")
-                    return Command(CommandType.NONE)
-                else:
-                    print("Sending a request...")
-                    request_str = self.generate_request_str(node_current, node_request)
-                    return Command(CommandType.REQUEST, request_str=request_str)
+                return self.request_or_none()
             
             # try all objects relevant to the current targets
-            for obj_name in self.get_relevant_objects(target_set):
-                print("Considering ", obj_name, "...")
-                relevant_obj = self.graspable_objects[obj_name]
-                composite_constraint_map = self.composite_constraint_map(relevant_obj, constraint_set)
-
-                # try out all target options
-                for target in target_set:
-                    target_map = self.gradient_map_from_guard(relevant_obj, guard=target)
-
-                    # remove the composite constraint from the map
-                    if constraint_set:
-                        assert len(target_map) == len(composite_constraint_map)
-                        for v in range(len(target_map)):
-                            if composite_constraint_map[v] > 0:
-                                target_map[v] = np.nan
-                    
-                    # find the best point for the object
-                    target_point = self.find_best_point(np.array(target_map).reshape(self.gx.shape), threshold=0)
-
-                    # if we found a point, good!
-                    if target_point is not None:
-                        print("Found a point for ",obj_name, "!")
-                        #self.visualize_map(target_map, target_point, self.graspable_objects)
-                        return Command(CommandType.EXECUTE, obj_name=obj_name, new_pos=target_point, edge=edge)
+            command = self.find_placement(target_set, constraint_set, edge, self.get_relevant_objects(target_set))
+            if command is not None:
+                return command
             
             # this edge is completely impossible by moving a single object, we prune the edge from the automaton 
             # (and remember it for future requests)
-            if target_obj is None:
-                print("Chosen edge turned out to be impossible. Pruning the edge...")
-                self.prune_edge(edge)
-        
-    
\ No newline at end of file
+            print("Chosen edge turned out to be impossible. Pruning the edge...")
+            self.prune_edge(edge)
+
+    def get_next_step_guided(self) -> Command:
+        """Like get_next_step, but explores the outgoing edges best-first by their estimated cost
+        and only computes maps for objects that can flip all required propositions on their own."""
+        print("Searching for target transition (guided)...")
+
+        # we are currently accepting, so we don't need to do anything
+        if self.planner.currently_accepting():
+            print("Specification satisfied, no action necessary.")
+            return Command(CommandType.NONE)
+
+        # re-rank after every pruned edge, since pruning changes the path lengths
+        while True:
+            ranked = self.rank_edges(self.planner.current_state)
+
+            # no path to accepting state exists, check for possible request
+            if not ranked:
+                return self.request_or_none()
+
+            score, edge, obj_names = ranked[0]
+            print("Trying edge", edge, "with estimated cost", score)
+            command = None
+            if score != float('inf'):
+                target_set, constraint_set = self.edge_guards(edge)
+                command = self.find_placement(target_set, constraint_set, edge, sorted(obj_names))
+            if command is not None:
+                return command
+
+            print("Chosen edge turned out to be impossible. Pruning the edge...")
+            self.prune_edge(edge)
+
+    def save(self, path, include_maps=False):
+        """Writes a snapshot of the planner session to a compressed .npz file.
+        The snapshot holds the DFA, AP order, current state, pruned edges and optionally the cached maps."""
+        last_command = None
+        if self.last_command is not None:
+            last_command = {
+                "type": self.last_command.type.name,
+                "obj_name": self.last_command.name,
+                "new_pos": None if self.last_command.new_pos is None else list(self.last_command.new_pos),
+                "edge": self.last_command.edge,
+                "request_str": self.last_command.request_str,
+            }
+
+        state = {
+            "spec": self.spec,
+            "bounds": list(self.bounds),
+            "samples": self.samples,
+            "edge_selection": self.edge_selection,
+            "scene_resolution": float(self.scene_resolution),
+            "feasibility_memory_size": self.feasibility_memory_size,
+            "refine_evaluations": self.refine_evaluations,
+            "refine_starts": self.refine_starts,
+            "objects": [{"name": obj.name, "color": obj.color, "proj_points": np.asarray(obj.proj_points).tolist()}
+                        for obj in self.graspable_objects.values()],
+            "dfa": dfa_to_dict(self.orig_dfa),
+            "trace_ap": self.trace_ap,
+            "current_state": self.planner.current_state,
+            "pruned_edges": self.pruned_edges,
+            "feasibility_memory": [[list(edge), scene] for edge, scene in self.feasibility_memory.keys()],
+            "last_command": last_command,
+            "maps": [],
+        }
+
+        arrays = {}
+        if include_maps:
+            for i, (key, values) in enumerate(self.map_cache.items()):
+                state["maps"].append(list(key))
+                arrays["map_%d" % i] = values
+
+        # write through a file handle, numpy would append .npz to the path otherwise and load could not find it
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, state=np.array(json.dumps(state)), **arrays)
+
+    @classmethod
+    def load(cls, path, map_exporter=None):
+        """Restores a planner session from a snapshot written by save, without rebuilding the DFA.
+        The map exporter is not part of the snapshot and has to be passed again."""
+        with np.load(path) as data:
+            state = json.loads(str(data["state"]))
+            arrays = {name: data[name] for name in data.files if name != "state"}
+
+        dfa = dfa_from_dict(state["dfa"])
+
+        objects = [ProjectedObject(name=obj["name"], color=obj["color"], proj_points=np.asarray(obj["proj_points"]))
+                   for obj in state["objects"]]
+        planner = cls(state["spec"], objects, state["bounds"], state["samples"],
+                      edge_selection=state["edge_selection"],
+                      scene_resolution=state["scene_resolution"],
+                      feasibility_memory_size=state["feasibility_memory_size"],
+                      dfa=dfa,
+                      refine_evaluations=state.get("refine_evaluations", 0),
+                      refine_starts=state.get("refine_starts", 3),
+                      map_exporter=map_exporter)
+        assert planner.trace_ap == state["trace_ap"], "Snapshot does not match the specification's AP order"
+
+        planner.planner.current_state = state["current_state"]
+        for edge, scene in state["feasibility_memory"]:
+            scene = tuple(tuple(s) for s in scene)
+            planner.feasibility_memory[(tuple(edge), scene)] = False
+
+        # disable the pruned edges again, keeping their recorded costs
+        planner.pruned_edges = state["pruned_edges"]
+        for node_cur, candidates in planner.pruned_edges.items():
+            for candidate in candidates:
+                planner.planner.dfa.remove_edge(node_cur, candidate["node_to"])
+
+        for i, key in enumerate(state["maps"]):
+            planner.map_cache[tuple(key)] = arrays["map_%d" % i]
+
+        last_command = state["last_command"]
+        if last_command is not None:
+            planner.last_command = Command(
+                CommandType[last_command["type"]],
+                obj_name=last_command["obj_name"],
+                new_pos=None if last_command["new_pos"] is None else np.asarray(last_command["new_pos"]),
+                edge=None if last_command["edge"] is None else tuple(last_command["edge"]),
+                request_str=last_command["request_str"])
+
+        return planner
@@ -0,0 +1,78 @@
+from spatial_requests.cache import cache_dir, load_dfa, store_dfa
+
+import argparse
+import json
+import os
+import time
+
+# fields of an init message, see PlannerService.on_init
+required_init_fields = ["specification", "workspace", "banana", "brick", "hammer"]
+
+def warmup_spec(spec):
+    """Builds and caches the DFA of a specification, unless it is already cached"""
+    if load_dfa(spec) is not None:
+        print("DFA already cached:", spec)
+        return
+
+    from spatial_spec.logic import Spatial
+    from spatial_spec.automaton_planning import AutomatonPlanner
+
+    planner = AutomatonPlanner()
+    planner.tree_to_dfa(Spatial(quantitative=True).parse(spec))
+    assert planner.dfa is not None, "DFA construction failed for: %s" % spec
+    store_dfa(spec, planner.dfa)
+    print("DFA cached:", spec, "(nodes:", len(planner.dfa.nodes), ", edges:", len(planner.dfa.edges), ")")
+
+def warmup_scene(init_file, snapshot_path):
+    """Initializes the planner from an init message, computes the maps of the first step and saves a snapshot,
+    so the service can restore the scene with a load request instead of recomputing it"""
+    from spatial_requests.planner_service import PlannerService
+
+    with open(init_file) as f:
+        msg = json.load(f)
+
+    missing = [key for key in required_init_fields if key not in msg]
+    if missing:
+        raise ValueError("%s is missing %s, an init message needs: %s"
+                         % (init_file, ", ".join(missing), ", ".join(required_init_fields)))
+
+    service = PlannerService()
+    service.on_init(msg)
+    service.planner.get_next_step()
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+    service.planner.save(snapshot_path, include_maps=True)
+    print("Snapshot saved:", snapshot_path, "(maps:", len(service.planner.map_cache), ")")
+
+def main():
+    parser = argparse.ArgumentParser(description="Prebuilds the DFA and grammar caches of the planner service.")
+    parser.add_argument("specs", nargs="*", help="specifications to prebuild")
+    parser.add_argument("--spec-file", help="file with one specification per line")
+    parser.add_argument("--init", help="init message (specification, workspace bounds and objects) to precompute")
+    parser.add_argument("--snapshot", default="snapshots/warmup_snapshot.npz",
+                        help="where the snapshot of --init is saved, the service loads from its --snapshot-dir")
+    args = parser.parse_args()
+
+    specs = list(args.specs)
+    if args.spec_file:
+        with open(args.spec_file) as f:
+            specs.extend(line.strip() for line in f if line.strip())
+
+    start = time.time()
+    print("Cache directory:", cache_dir())
+
+    for spec in specs:
+        warmup_spec(spec)
+
+    # the reconstructor writes its parser tables to the cache on first build
+    from spatial_requests.spatial_request_planner import build_reconstructor
+    build_reconstructor()
+    print("Grammar cached.")
+
+    # the planner builds (or reads) the DFA of the init specification on its own
+    if args.init:
+        try:
+            warmup_scene(args.init, args.snapshot)
+        except ValueError as e:
+            parser.error(str(e))
+
+    print("Warm-up finished in %.2f s." % (time.time() - start))